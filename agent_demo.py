@@ -1,10 +1,19 @@
+import ast
+import hashlib
+import inspect
 import json
 import re
 import os
+import orjson
 import requests
+import threading
 import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables
 load_dotenv()
@@ -19,6 +28,31 @@ AVAILABLE_TOOLS = {
     "add_numbers": add_numbers,
 }
 
+# 工具的 JSON Schema（OpenAI 函数调用格式），根据函数签名和文档字符串自动生成，
+# 由服务端按 schema 生成结构化的工具调用，不再需要从文本中正则提取 JSON
+JSON_SCHEMA_TYPES = {float: "number", int: "integer", str: "string", bool: "boolean"}
+
+def _tool_schema(name: str, func) -> Dict[str, Any]:
+    """根据函数签名生成工具的 JSON Schema"""
+    parameters = inspect.signature(func).parameters
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": inspect.getdoc(func) or "",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    arg: {"type": JSON_SCHEMA_TYPES.get(param.annotation, "string")}
+                    for arg, param in parameters.items()
+                },
+                "required": [arg for arg, param in parameters.items() if param.default is inspect.Parameter.empty],
+            },
+        },
+    }
+
+TOOLS = [_tool_schema(name, func) for name, func in AVAILABLE_TOOLS.items()]
+
 # DeepSeek API 配置
 DEEPSEEK_CONFIG = {
     "api_key": os.getenv("DEEPSEEK_API_KEY"),
@@ -28,152 +62,682 @@ DEEPSEEK_CONFIG = {
     "max_tokens": 2000
 }
 
-# 3. 真实的 DeepSeek API 调用函数（带重试逻辑）
-def call_llm(history: list, system_prompt: str, max_retries: int = 3) -> str:
-    """调用 DeepSeek API 并返回响应文本"""
+# 最大并发请求数，不应超过服务商允许的并发上限
+LLM_CONCURRENCY = int(os.getenv("DEEPSEEK_MAX_CONCURRENCY", "16"))
+LLM_SEMAPHORE = threading.BoundedSemaphore(LLM_CONCURRENCY)
+
+# 重试等待期间线程仍占用 LLM_SEMAPHORE，所以服务端的 Retry-After 也要设上限
+# （backoff_max 只限制指数退避，不限制 Retry-After）
+RETRY_AFTER_MAX = 30
+
+class CappedRetry(Retry):
+    """遵守 Retry-After，但等待时间不超过 RETRY_AFTER_MAX 秒"""
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, RETRY_AFTER_MAX)
+
+# 重试策略：只重试连接错误、超时、429 和 5xx（其他 4xx 直接失败），
+# 指数退避并加随机抖动，避免并发调用方同步重试；429 时优先遵守服务端的 Retry-After
+LLM_RETRY = CappedRetry(
+    total=3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"POST"}),
+    backoff_factor=1,
+    backoff_max=30,
+    backoff_jitter=1.0,
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+# 共享的 HTTP 会话：通过 keep-alive 连接池复用 TCP + TLS 连接，
+# 避免 Agent 每一步都重新握手
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=LLM_CONCURRENCY, max_retries=LLM_RETRY))
+
+# 检查 API 密钥（模块加载时检查一次）
+if not DEEPSEEK_CONFIG["api_key"]:
+    raise ValueError("DeepSeek API key not found. Please set DEEPSEEK_API_KEY environment variable.")
+
+# API 地址和请求头（模块加载时构建一次）
+DEEPSEEK_URL = DEEPSEEK_CONFIG["base_url"].rstrip("/") + "/chat/completions"
+DEEPSEEK_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {DEEPSEEK_CONFIG['api_key']}"
+}
+
+# 固定不变的请求参数模板，每次调用复制后再填入 messages
+PAYLOAD_TEMPLATE = {
+    "model": DEEPSEEK_CONFIG["model"],
+    "temperature": DEEPSEEK_CONFIG["temperature"],
+    "max_tokens": DEEPSEEK_CONFIG["max_tokens"],
+    "stream": True,
+    "stream_options": {"include_usage": True}
+}
+
+# 中间步骤（Thought + 一次工具调用）的输出预算，通常不到 100 个 token；
+# 较小的 max_tokens 让服务端更快调度，被截断时再用完整预算重试
+STEP_MAX_TOKENS = 256
+
+# 预编译 LLM 输出解析用的正则表达式，避免在 Agent Loop 中重复编译
+# （ACTION_RE 用于兼容仍按文本协议输出 [ACTION_START]...[ACTION_END] 的模型）
+ACTION_END_TAG = "[ACTION_END]"
+ACTION_RE = re.compile(r"\[ACTION_START\]\s*(\{.*?\}|\[.*?\])\s*\[ACTION_END\]", re.DOTALL)
+FINAL_ANSWER_RE = re.compile(r"Final Answer:\s*(.*)", re.DOTALL)
+
+# 响应缓存：相同的 messages（含系统提示词）直接返回上次的结果，跳过网络请求
+# 只缓存低温度（近似确定性）的输出；设置 DEEPSEEK_NO_CACHE=1 可关闭缓存便于调试
+# 按 LRU 淘汰并限制条目数，过期条目在读写时一并清理，长时间运行时内存不会无限增长
+RESPONSE_CACHE: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (响应消息, 写入时间戳)，按最近使用排序
+RESPONSE_CACHE_TTL = 24 * 3600
+RESPONSE_CACHE_MAX_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", "1024"))
+RESPONSE_CACHE_LOCK = threading.Lock()
+RESPONSE_CACHE_MAX_TEMPERATURE = 0.2
+RESPONSE_CACHE_ENABLED = os.getenv("DEEPSEEK_NO_CACHE", "").lower() not in ("1", "true", "yes")
+
+# 保护语义缓存和计划模板缓存的加载与落盘，多个 Agent 并发运行时不会互相覆盖
+CACHE_LOCK = threading.RLock()
+
+def _response_cache_key(messages: list) -> str:
+    """根据消息列表（含系统提示词）计算缓存键"""
+    data = orjson.dumps(messages, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(data).hexdigest()
+
+def _response_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    """读取未过期的缓存响应，命中时标记为最近使用"""
+    with RESPONSE_CACHE_LOCK:
+        cached = RESPONSE_CACHE.get(key)
+        if cached is None:
+            return None
+        if time.time() - cached[1] >= RESPONSE_CACHE_TTL:
+            del RESPONSE_CACHE[key]
+            return None
+        RESPONSE_CACHE.move_to_end(key)
+        return cached[0]
+
+def _response_cache_put(key: str, message: Dict[str, Any]) -> None:
+    """写入缓存响应，并淘汰过期条目和超出容量的最久未使用条目"""
+    now = time.time()
+    with RESPONSE_CACHE_LOCK:
+        for expired_key in [k for k, (_, written_at) in RESPONSE_CACHE.items() if now - written_at >= RESPONSE_CACHE_TTL]:
+            del RESPONSE_CACHE[expired_key]
+        RESPONSE_CACHE[key] = (message, now)
+        RESPONSE_CACHE.move_to_end(key)
+        while len(RESPONSE_CACHE) > RESPONSE_CACHE_MAX_SIZE:
+            RESPONSE_CACHE.popitem(last=False)
+
+# 语义缓存：措辞不同但意图相同的用户输入（如 "计算 A 加 B" / "A 加 B 等于多少"）
+# 直接复用之前的 Final Answer，整个 Agent Loop 都不需要执行
+# 用字符 bigram 向量的余弦相似度近似语义相似度；数字必须完全一致，且数字之间的文字（运算顺序）
+# 也必须一致才算命中，避免答非所问（bigram 向量本身不区分词序）
+# 中文数字（如 "一百二十"、"两倍"）同样按数字处理；"一共" 这类词也会被当成数字，只会多一些未命中，不会误命中
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", ".semantic_cache.json")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+SEMANTIC_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?|[零〇一二两三四五六七八九十百千万亿]+")
+_semantic_entries: Optional[list] = None  # [{"prompt", "numbers", "answer"}]，首次使用时从磁盘加载
+_semantic_vectors: list = []  # 与 _semantic_entries 一一对应的 (向量, 数字, 数字间文字)
+
+def _embed_prompt(prompt: str) -> Counter:
+    """把用户输入转换为字符 bigram 计数向量（数字替换为占位符，忽略空白和标点）"""
+    text = "".join(re.findall(r"\w", SEMANTIC_NUMBER_RE.sub("#", prompt.lower())))
+    return Counter(text[i:i + 2] for i in range(max(len(text) - 1, 1)))
+
+def _number_gaps(prompt: str) -> list:
+    """提取相邻数字之间的文字（忽略空白和标点），用于保证运算顺序一致"""
+    parts = SEMANTIC_NUMBER_RE.split(prompt.lower())[1:-1]
+    return ["".join(re.findall(r"[\w+\-*/]", part)) for part in parts]
+
+def _semantic_key(prompt: str) -> tuple:
+    """计算语义缓存的 (向量, 数字, 数字间文字)"""
+    return _embed_prompt(prompt), SEMANTIC_NUMBER_RE.findall(prompt), _number_gaps(prompt)
+
+def _cosine(u: Counter, v: Counter) -> float:
+    """计算两个稀疏向量的余弦相似度"""
+    dot = sum(count * v[key] for key, count in u.items())
+    norm = (sum(c * c for c in u.values()) * sum(c * c for c in v.values())) ** 0.5
+    return dot / norm if norm else 0.0
+
+def _load_semantic_cache() -> list:
+    """从磁盘加载语义缓存"""
+    global _semantic_entries
+    with CACHE_LOCK:
+        if _semantic_entries is None:
+            entries = []
+            if os.path.exists(SEMANTIC_CACHE_PATH):
+                with open(SEMANTIC_CACHE_PATH, encoding="utf-8") as f:
+                    entries = json.load(f)
+            _semantic_vectors[:] = [_semantic_key(entry["prompt"]) for entry in entries]
+            _semantic_entries = entries
+    return _semantic_entries
+
+def semantic_cache_lookup(prompt: str) -> Optional[str]:
+    """查找语义相似的历史输入，命中则返回缓存的最终答案"""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    query, numbers, gaps = _semantic_key(prompt)
+    best_score, best_answer = 0.0, None
+    with CACHE_LOCK:
+        candidates = list(zip(_load_semantic_cache(), _semantic_vectors))
+    for entry, (vector, entry_numbers, entry_gaps) in candidates:
+        # 数字从 prompt 重新提取，而不是读取磁盘上的 numbers 字段（旧缓存文件只记录了阿拉伯数字）
+        if entry_numbers != numbers or entry_gaps != gaps:
+            continue
+        score = _cosine(query, vector)
+        if score > best_score:
+            best_score, best_answer = score, entry["answer"]
+    if best_score >= SEMANTIC_CACHE_THRESHOLD:
+        print(f"⚡ Semantic cache hit (similarity {best_score:.2f})")
+        return best_answer
+    return None
+
+def semantic_cache_store(prompt: str, answer: str) -> None:
+    """记录用户输入和最终答案，并持久化到磁盘"""
+    if not RESPONSE_CACHE_ENABLED:
+        return
+    with CACHE_LOCK:
+        entries = _load_semantic_cache()
+        entries.append({"prompt": prompt, "numbers": SEMANTIC_NUMBER_RE.findall(prompt), "answer": answer})
+        _semantic_vectors.append(_semantic_key(prompt))
+        with open(SEMANTIC_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False, indent=2)
+
+# 计划模板缓存：成功的运行结束后，把工具调用序列抽象成模板（参数引用用户输入中的第几个数字
+# 或前面某一步的结果），下次遇到同一句式的输入时直接执行模板，跳过所有 LLM 规划调用
+# 句式 = 把数字替换成占位符后的用户输入，数字顺序不同的句式不会误用同一模板
+PLAN_CACHE_PATH = os.getenv("PLAN_CACHE_PATH", ".plan_cache.json")
+_plan_cache: Optional[Dict[str, list]] = None  # 句式 -> 计划模板，首次使用时从磁盘加载
+
+def _parse_number(text: str) -> float:
+    """解析用户输入中的数字，整数保持为 int"""
+    return float(text) if "." in text else int(text)
+
+def _plan_key(prompt: str) -> str:
+    """计算用户输入的句式（数字替换为占位符，忽略空白和标点）"""
+    return "".join(re.findall(r"[\w#+\-*/]", NUMBER_RE.sub("#", prompt.lower())))
+
+def _load_plan_cache() -> Dict[str, list]:
+    """从磁盘加载计划模板缓存"""
+    global _plan_cache
+    with CACHE_LOCK:
+        if _plan_cache is None:
+            plans = {}
+            if os.path.exists(PLAN_CACHE_PATH):
+                with open(PLAN_CACHE_PATH, encoding="utf-8") as f:
+                    plans = json.load(f)
+            _plan_cache = plans
+    return _plan_cache
+
+SIGNED_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+def _arg_ref(value: Any, numbers: list, results: list) -> Optional[Dict[str, Any]]:
+    """把一个具体参数值映射为对输入数字或前序结果的引用；无法映射或有多种映射（有歧义）时返回 None"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    refs = []
+    for sign in (1, -1):
+        refs += [{"num": i, "sign": sign} for i, number in enumerate(numbers) if value == sign * number]
+        refs += [{"step": i, "sign": sign} for i, result in enumerate(results) if value == sign * result]
+    return refs[0] if len(refs) == 1 else None
+
+def plan_cache_store(prompt: str, tool_calls: list, final_answer: str) -> None:
+    """从一次成功运行的工具调用记录 [(action_dict, result)] 中抽取计划模板并持久化"""
+    if not RESPONSE_CACHE_ENABLED or not tool_calls:
+        return
+    # 只有最终答案就是最后一步的结果（取答案中最后一个数字比较）时，模板才可复用；
+    # 否则说明模型在工具之外自己做了计算，重放模板会得到错误结果
+    answer_numbers = SIGNED_NUMBER_RE.findall(final_answer)
+    try:
+        if not answer_numbers or float(answer_numbers[-1]) != float(tool_calls[-1][1]):
+            return
+    except (TypeError, ValueError):
+        return
+    numbers = [_parse_number(n) for n in NUMBER_RE.findall(prompt)]
+    results = []
+    template = []
+    used_numbers = set()
+    for action_dict, result in tool_calls:
+        args_schema = {}
+        for name, value in action_dict["args"].items():
+            ref = _arg_ref(value, numbers, results)
+            if ref is None:
+                return
+            if "num" in ref:
+                used_numbers.add(ref["num"])
+            args_schema[name] = ref
+        template.append({"tool": action_dict["tool"], "args_schema": args_schema})
+        results.append(result)
+    # 输入中的每个数字都必须参与计算，否则模板没有覆盖完整的任务
+    if len(used_numbers) != len(numbers):
+        return
+    with CACHE_LOCK:
+        plans = _load_plan_cache()
+        plans[_plan_key(prompt)] = template
+        with open(PLAN_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(plans, f, ensure_ascii=False, indent=2)
+
+def run_cached_plan(prompt: str) -> Optional[Any]:
+    """按缓存的计划模板直接执行工具序列，返回最后一步的结果；无模板或执行失败时返回 None"""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    template = _load_plan_cache().get(_plan_key(prompt))
+    if template is None:
+        return None
+    numbers = [_parse_number(n) for n in NUMBER_RE.findall(prompt)]
+    results = []
+    try:
+        for plan_step in template:
+            tool_args = {}
+            for name, ref in plan_step["args_schema"].items():
+                value = numbers[ref["num"]] if "num" in ref else results[ref["step"]]
+                tool_args[name] = ref["sign"] * value
+            print(f"🛠️ Executing Cached Plan Tool: {plan_step['tool']} with args: {tool_args}")
+            results.append(AVAILABLE_TOOLS[plan_step["tool"]](**tool_args))
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        print(f"❌ Cached plan failed, falling back to agent loop: {e}")
+        return None
+    print("⚡ Plan cache hit")
+    return results[-1]
+
+# 3. 真实的 DeepSeek API 调用函数
+def call_llm(messages: list, tools: Optional[list] = None, early_exit: bool = True,
+             max_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """调用 DeepSeek API 并返回 assistant 消息（流式接收，early_exit 时在 Action 输出完整后立即返回）
     
-    # 检查 API 密钥
-    if not DEEPSEEK_CONFIG["api_key"]:
-        raise ValueError("DeepSeek API key not found. Please set DEEPSEEK_API_KEY environment variable.")
+    返回的消息包含 content，模型发起函数调用时还包含 tool_calls，可以直接追加到 messages 中。
+    max_tokens 小于配置的预算时，如果输出因长度被截断，会自动用完整预算重新请求。
     
-    # 准备 API 请求数据
-    messages = []
+    messages 由调用方增量维护并直接发送：第一条必须是系统提示词，且在整个循环中逐字节不变
+    （不插入时间戳等动态内容），这样 DeepSeek 的自动前缀缓存才能命中；观察结果等动态内容只能追加在其后
+    """
     
-    # 添加系统提示词
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
+    # API 请求参数
+    payload = {**PAYLOAD_TEMPLATE, "messages": messages}
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+    if tools:
+        payload["tools"] = tools
+        payload["tool_choice"] = "auto"
     
-    # 添加历史对话记录
-    for msg in history[1:]:  # 跳过第一个系统消息，因为我们已经单独添加了
-        if msg["role"] in ["user", "assistant", "system"]:
-            messages.append({"role": msg["role"], "content": msg["content"]})
-        elif msg["role"] == "tool":
-            # 将工具响应转换为用户消息格式，以便模型理解
-            messages.append({"role": "user", "content": msg["content"]})
+    # 先查响应缓存
+    use_cache = RESPONSE_CACHE_ENABLED and PAYLOAD_TEMPLATE["temperature"] <= RESPONSE_CACHE_MAX_TEMPERATURE
+    if use_cache:
+        cache_key = _response_cache_key(messages)
+        cached = _response_cache_get(cache_key)
+        if cached is not None:
+            print("⚡ Response cache hit")
+            return cached
     
-    # API 请求参数
-    payload = {
-        "model": DEEPSEEK_CONFIG["model"],
-        "messages": messages,
-        "temperature": DEEPSEEK_CONFIG["temperature"],
-        "max_tokens": DEEPSEEK_CONFIG["max_tokens"],
-        "stream": False
-    }
+    # 重试由 SESSION 上的 urllib3 Retry 负责
+    try:
+        # 以流式方式发送 API 请求（复用会话连接池，连接/读取分别设置超时）
+        # 信号量限制同时进行的请求数
+        llm_response = ""
+        tool_calls = []
+        finish_reason = None
+        search_from = 0  # 只在新到达的内容中查找 [ACTION_END]，避免每个数据块都重新扫描整个缓冲区
+        with LLM_SEMAPHORE:
+            with SESSION.post(
+                DEEPSEEK_URL,
+                headers=DEEPSEEK_HEADERS,
+                data=orjson.dumps(payload),
+                timeout=(10, 30),
+                stream=True
+            ) as response:
+                
+                # 检查响应状态
+                response.raise_for_status()
+                
+                # 逐行解析 SSE 数据，累积增量内容
+                for line in response.iter_lines():
+                    if not line.startswith(b"data: "):
+                        continue
+                    data = line[len(b"data: "):]
+                    if data == b"[DONE]":
+                        break
+                    chunk = orjson.loads(data)
+                    
+                    # 记录前缀缓存命中情况，用于验证系统提示词是否被缓存（usage 在最后一个数据块中）
+                    usage = chunk.get("usage") or {}
+                    if "prompt_cache_hit_tokens" in usage:
+                        print(f"📦 Prompt cache: {usage['prompt_cache_hit_tokens']} hit / "
+                              f"{usage.get('prompt_cache_miss_tokens', 0)} miss tokens")
+                    
+                    for choice in chunk["choices"]:
+                        delta = choice["delta"]
+                        finish_reason = choice.get("finish_reason") or finish_reason
+                        llm_response += delta.get("content") or ""
+                        
+                        # 函数调用按 index 分片下发，逐片拼接名称和参数
+                        for call_delta in delta.get("tool_calls") or []:
+                            while len(tool_calls) <= call_delta["index"]:
+                                tool_calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                            call = tool_calls[call_delta["index"]]
+                            call["id"] = call_delta.get("id") or call["id"]
+                            function = call_delta.get("function") or {}
+                            call["function"]["name"] += function.get("name") or ""
+                            call["function"]["arguments"] += function.get("arguments") or ""
+                    
+                    # 提前结束：Action 一旦完整输出，后面的内容都会被丢弃，直接断开连接让服务端停止生成
+                    # （Final Answer 之后的文本就是答案本身，所以不能在看到 Final Answer 时截断）
+                    if early_exit and llm_response.find(ACTION_END_TAG, search_from) != -1 and ACTION_RE.search(llm_response):
+                        break
+                    search_from = max(0, len(llm_response) - len(ACTION_END_TAG) + 1)
+        
+        # 输出因 max_tokens 被截断时，用完整预算重新请求
+        if finish_reason == "length" and payload["max_tokens"] < DEEPSEEK_CONFIG["max_tokens"]:
+            print(f"⚠️ Response truncated at max_tokens={payload['max_tokens']}, retrying with full budget")
+            return call_llm(messages, tools=tools, early_exit=early_exit)
+        
+        message = {"role": "assistant", "content": llm_response.strip()}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        if use_cache:
+            _response_cache_put(cache_key, message)
+        
+        return message
+        
+    except requests.exceptions.RequestException as e:
+        # 可重试的错误已由连接池层重试过，这里直接失败
+        error_msg = f"API request failed: {str(e)}"
+        print(f"❌ {error_msg}")
+        return {"role": "assistant", "content": f"Error: {error_msg}"}
     
-    # API 请求头
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_CONFIG['api_key']}"
-    }
+    except (KeyError, IndexError, orjson.JSONDecodeError) as e:
+        error_msg = f"Failed to parse API response: {str(e)}"
+        print(f"❌ {error_msg}")
+        return {"role": "assistant", "content": f"Error: {error_msg}"}
+
+# 工具执行线程池：同一轮中的多个独立工具调用并发执行（对 HTTP/数据库类工具效果明显）
+TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+def parse_actions(action_json_str: str) -> list:
+    """解析 Action JSON，可以是单个对象或对象数组
     
-    # 重试逻辑
-    for attempt in range(max_retries):
-        try:
-            # 发送 API 请求
-            response = requests.post(
-                f"{DEEPSEEK_CONFIG['base_url']}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            # 检查响应状态
-            response.raise_for_status()
-            
-            # 解析响应数据
-            result = response.json()
-            llm_response = result["choices"][0]["message"]["content"]
-            
-            return llm_response.strip()
-            
-        except requests.exceptions.RequestException as e:
-            error_msg = f"API request failed (attempt {attempt + 1}/{max_retries}): {str(e)}"
-            print(f"❌ {error_msg}")
-            
-            if attempt == max_retries - 1:  # 最后一次尝试失败
-                return f"Error: {error_msg}"
-            
-            # 等待一段时间后重试（指数退避）
-            wait_time = 2 ** attempt
-            print(f"⏳ Retrying in {wait_time} seconds...")
-            time.sleep(wait_time)
-            
-        except (KeyError, IndexError) as e:
-            error_msg = f"Failed to parse API response: {str(e)}"
-            print(f"❌ {error_msg}")
-            return f"Error: {error_msg}"
-    
-    return "Error: Maximum retry attempts exceeded."
+    流式接收时第一个完整的 [ACTION_START]...[ACTION_END] 到达后就会断开连接，
+    因此一轮中只支持一个 Action 块，多个工具调用需要放在同一个块的数组中。
+    """
+    parsed = orjson.loads(action_json_str)
+    actions = parsed if isinstance(parsed, list) else [parsed]
+    for action_dict in actions:
+        if not isinstance(action_dict, dict):
+            raise ValueError(f"Invalid action: {action_dict}")
+    return actions
+
+def parse_tool_call(tool_call: Dict[str, Any]) -> Dict[str, Any]:
+    """把函数调用转换为 {"tool", "args"} 格式的 Action；参数 JSON 无效时保留原始字符串，执行时报错"""
+    function = tool_call["function"]
+    try:
+        tool_args = orjson.loads(function["arguments"] or "{}")
+    except orjson.JSONDecodeError:
+        tool_args = function["arguments"]
+    return {"tool": function["name"], "args": tool_args}
+
+def _run_action(action_dict: Dict[str, Any]) -> tuple:
+    """执行单个工具调用，返回 (结果, 错误)"""
+    try:
+        tool_name = action_dict["tool"]
+        tool_args = action_dict["args"]
+        
+        print(f"🛠️ Executing Tool: {tool_name} with args: {tool_args}")
+        
+        # 动态调用函数
+        if tool_name not in AVAILABLE_TOOLS:
+            raise ValueError(f"Tool {tool_name} not registered.")
+        if not isinstance(tool_args, dict):
+            raise ValueError(f"Invalid args for tool {tool_name}: {tool_args}")
+        
+        tool_function = AVAILABLE_TOOLS[tool_name]
+        return tool_function(**tool_args), None
+    except (KeyError, ValueError, TypeError) as e:
+        return None, e
+
+# 本地快速路径：纯算术的用户输入（允许中文运算词）直接在本地安全求值，完全不调用 LLM
+ARITHMETIC_WORDS = [("加上", "+"), ("减去", "-"), ("乘以", "*"), ("除以", "/"),
+                    ("加", "+"), ("减", "-"), ("乘", "*"), ("除", "/"), ("×", "*"), ("÷", "/"),
+                    ("（", "("), ("）", ")")]
+ARITHMETIC_FILLERS = re.compile(r"^(请|帮我)?(计算|算一下|求)?|(的结果|结果|等于)?(是多少|等于多少|是什么|多少)?[=＝\s?？。]*$")
+ARITHMETIC_RE = re.compile(r"^[\s\d+\-*/().]+$")
+ARITHMETIC_MAX_LENGTH = 200  # 过长的表达式交给 LLM，避免解析/求值时递归过深
+ARITHMETIC_OPS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,
+}
+
+def _eval_arithmetic(node: ast.AST) -> float:
+    """只允许数字和四则运算的 AST 求值"""
+    if isinstance(node, ast.Expression):
+        return _eval_arithmetic(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in ARITHMETIC_OPS:
+        return ARITHMETIC_OPS[type(node.op)](_eval_arithmetic(node.left), _eval_arithmetic(node.right))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        value = _eval_arithmetic(node.operand)
+        return -value if isinstance(node.op, ast.USub) else value
+    raise ValueError(f"Unsupported expression: {ast.dump(node)}")
+
+def try_local_arithmetic(prompt: str) -> Optional[float]:
+    """如果用户输入是纯算术表达式则直接计算，否则返回 None"""
+    expression = ARITHMETIC_FILLERS.sub("", prompt.strip())
+    for word, operator in ARITHMETIC_WORDS:
+        expression = expression.replace(word, operator)
+    expression = expression.strip()
+    if len(expression) > ARITHMETIC_MAX_LENGTH or not ARITHMETIC_RE.match(expression):
+        return None
+    try:
+        result = _eval_arithmetic(ast.parse(expression, mode="eval"))
+    except (SyntaxError, ValueError, ZeroDivisionError, OverflowError, RecursionError):
+        return None
+    if isinstance(result, float) and result.is_integer():
+        result = int(result)
+    print(f"⚡ Evaluated locally: {expression} = {result}")
+    return result
+
+# 历史记录滑动窗口：历史总长度超过上限时，保留系统提示词、原始用户指令和最近几轮，
+# 更早的轮次用本地生成的工具调用摘要替换（无需额外的 LLM 调用），使每一步的 prefill 开销保持平稳
+# 保留的轮数不超过 max_steps 的一半，否则步数较少时压缩永远不会触发
+HISTORY_CHAR_LIMIT = 8000
+HISTORY_KEEP_TURNS = 4
+
+def compact_history(history: list, turns: list, keep_turns: int = HISTORY_KEEP_TURNS) -> None:
+    """原地压缩历史记录；turns 记录 system/user 之后每一轮的 (消息条数, 摘要)"""
+    if len(turns) <= keep_turns or sum(len(msg["content"] or "") for msg in history) <= HISTORY_CHAR_LIMIT:
+        return
+    kept_turns = turns[-keep_turns:]
+    kept_messages = sum(count for count, _ in kept_turns)
+    summary = "; ".join(turn_summary for _, turn_summary in turns[:-keep_turns])
+    history[2:] = [{"role": "user", "content": f"[Earlier steps summarized: {summary}]"}] + history[-kept_messages:]
+    # 摘要本身作为一轮保留，下次压缩时会与更多早期轮次合并
+    turns[:] = [(1, summary)] + kept_turns
+    print(f"✂️ History compacted to {len(history)} messages")
 
 # 4. Agent 主循环函数
 def run_agent_loop(initial_user_prompt: str, system_prompt: str, max_steps=5) -> str:
     
+    # 纯算术输入直接本地计算，无需调用 LLM
+    local_result = try_local_arithmetic(initial_user_prompt)
+    if local_result is not None:
+        return f"\n✅ Agent Finished! Final Answer: {local_result}"
+    
+    # 语义缓存命中时直接返回，无需进入循环
+    cached_answer = semantic_cache_lookup(initial_user_prompt)
+    if cached_answer is not None:
+        return f"\n✅ Agent Finished! Final Answer: {cached_answer}"
+    
+    # 计划模板命中时直接执行缓存的工具序列，跳过 LLM 规划
+    plan_result = run_cached_plan(initial_user_prompt)
+    if plan_result is not None:
+        return f"\n✅ Agent Finished! Final Answer: {plan_result}"
+    
     # 历史记录初始化：只有 System Prompt 和用户指令
+    # history 就是发给 API 的 messages，每一步只追加，不再整体重建
     history = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": initial_user_prompt}
     ]
     
+    # 成功执行的工具调用记录 [(action_dict, result)]，用于抽取计划模板
+    tool_calls = []
+    # 每一轮的 (消息条数, 摘要)，用于压缩历史记录
+    turns = []
+    keep_turns = max(1, min(HISTORY_KEEP_TURNS, max_steps // 2))
+    
     # 开始 Agent Loop
     for step in range(max_steps):
         print(f"\n--- 🔄 Step {step + 1} ---")
         
         # 4a. 感知与思考 (Perception & Thinking)
-        llm_response = call_llm(history, system_prompt)
+        compact_history(history, turns, keep_turns)
+        message = call_llm(history, tools=TOOLS, max_tokens=STEP_MAX_TOKENS)
+        llm_response = message["content"]
         print(f"LLM Response:\n{llm_response}")
         
         # 4b. 检查 Final Answer 标签 (判断终结)
-        if "Final Answer:" in llm_response:
-            final_answer = llm_response.split("Final Answer:", 1)[1].strip()
+        final_match = FINAL_ANSWER_RE.search(llm_response)
+        if final_match and not message.get("tool_calls"):
+            final_answer = final_match.group(1).strip()
+            semantic_cache_store(initial_user_prompt, final_answer)
+            plan_cache_store(initial_user_prompt, tool_calls, final_answer)
             return f"\n✅ Agent Finished! Final Answer: {final_answer}"
         
         # 4c. 检查 Action (判断工具调用)
-        # 使用正则表达式来提取被 [ACTION_START] 和 [ACTION_END] 包裹的 JSON
-        action_match = re.search(r"\[ACTION_START\]\s*(\{.*?\})\s*\[ACTION_END\]", llm_response, re.DOTALL)
-        
-        if action_match:
-            # 找到 Action，将其添加到历史记录中
-            action_json_str = action_match.group(1)
-            history.append({"role": "assistant", "content": llm_response})
-            
-            # 4d. 解析 Action 并执行工具 (Action & Execution)
+        # 优先使用服务端返回的结构化函数调用；兼容按文本协议输出
+        # [ACTION_START] 和 [ACTION_END] 包裹的 JSON（单个对象或对象数组）的模型，
+        # 流式接收在第一个完整的 Action 块后就会结束，所以只解析这一个块
+        native_calls = message.get("tool_calls")
+        action_match = None if native_calls else ACTION_RE.search(llm_response)
+        
+        if not native_calls and not action_match:
+            # LLM 没有给出 Final Answer 也没有给出 Action，视为错误或中间文本
+            print("🛑 Error: LLM output is ambiguous. Stopping.")
+            return "❌ Agent failed to produce a valid action or final answer."
+        
+        # 找到 Action，将其添加到历史记录中
+        history.append(message)
+        
+        # 4d. 解析 Action 并执行工具 (Action & Execution)
+        if native_calls:
+            actions = [parse_tool_call(call) for call in native_calls]
+        else:
             try:
-                action_dict = json.loads(action_json_str)
-                tool_name = action_dict["tool"]
-                tool_args = action_dict["args"]
-                
-                print(f"🛠️ Executing Tool: {tool_name} with args: {tool_args}")
-                
-                # 动态调用函数
-                if tool_name not in AVAILABLE_TOOLS:
-                    raise ValueError(f"Tool {tool_name} not registered.")
-                
-                tool_function = AVAILABLE_TOOLS[tool_name]
-                observation_result = tool_function(**tool_args)
-                
-                # 4e. 格式化 Observation (新的感知)
-                observation_message = f"Observation: {observation_result}"
-                
-                # 4f. 更新历史记录 (闭环)
-                print(f"📢 Observation: {observation_result}")
-                history.append({
-                    "role": "tool", 
-                    "content": observation_message
-                })
-                
-            except (json.JSONDecodeError, KeyError, ValueError) as e:
+                actions = parse_actions(action_match.group(1))
+            except (orjson.JSONDecodeError, ValueError) as e:
                 # 错误处理：如果 LLM 输出的 JSON 有误，将错误作为 Observation 返回
                 error_message = f"Tool Execution Error: {e}"
                 print(f"❌ {error_message}")
-                history.append({"role": "tool", "content": f"Observation: {error_message}"})
+                history.append({"role": "user", "content": f"Observation: {error_message}"})
+                turns.append((2, f"invalid action ({e})"))
+                continue
         
+        # 多个相互独立的工具调用并发执行，结果按原顺序收集
+        if len(actions) == 1:
+            outcomes = [_run_action(actions[0])]
         else:
-            # LLM 没有给出 Final Answer 也没有给出 Action，视为错误或中间文本
-            print("🛑 Error: LLM output is ambiguous. Stopping.")
-            return "❌ Agent failed to produce a valid action or final answer."
+            outcomes = list(TOOL_EXECUTOR.map(_run_action, actions))
+        
+        # 4e. 格式化 Observation (新的感知)
+        observations = []
+        call_summaries = []
+        for action_dict, (observation_result, error) in zip(actions, outcomes):
+            call_summary = f"{action_dict.get('tool')}({action_dict.get('args')})"
+            if error is None:
+                tool_calls.append((action_dict, observation_result))
+                print(f"📢 Observation: {observation_result}")
+                observations.append(str(observation_result))
+                call_summaries.append(f"{call_summary}={observation_result}")
+            else:
+                error_message = f"Tool Execution Error: {error}"
+                print(f"❌ {error_message}")
+                observations.append(error_message)
+                call_summaries.append(f"{call_summary} failed: {error}")
+        
+        # 4f. 更新历史记录 (闭环)
+        if native_calls:
+            # 按函数调用协议，每个调用对应一条 tool 消息
+            for call, observation in zip(native_calls, observations):
+                history.append({"role": "tool", "tool_call_id": call["id"], "content": observation})
+            turns.append((1 + len(native_calls), "; ".join(call_summaries)))
+        else:
+            # 文本协议下工具响应以用户消息的形式追加，以便模型理解
+            history.append({
+                "role": "user", 
+                "content": "\n".join(f"Observation: {observation}" for observation in observations)
+            })
+            turns.append((2, "; ".join(call_summaries)))
 
     return "❌ Max steps reached without a final answer."
 
+# 5. 并发处理多个用户输入：每个输入独立运行 Agent Loop，共享连接池，
+# 并发数受 LLM_SEMAPHORE 限制，总耗时约为 ceil(N / 并发数) * 单次耗时
+def run_many(user_inputs: list, system_prompt: str) -> list:
+    """并发运行多个 Agent Loop，返回与输入一一对应的结果列表"""
+    with ThreadPoolExecutor(max_workers=LLM_CONCURRENCY) as executor:
+        return list(executor.map(lambda user_input: run_agent_loop(user_input, system_prompt), user_inputs))
+
+# 6. 批量处理：把多个独立任务打包进一次 API 调用（row-marshaling），
+# 摊薄网络往返和系统提示词的 prefill 开销；需要工具的任务再单独走 Agent Loop
+BATCH_SIZE = 8
+BATCH_RESULT_RE = re.compile(r"\[.*\]", re.DOTALL)
+
+def run_agent_batch(user_inputs: list, system_prompt: str, batch_size: int = BATCH_SIZE) -> list:
+    """批量处理多个用户输入，返回与输入一一对应的结果列表"""
+    results = [None] * len(user_inputs)
+    
+    # 纯算术或语义缓存命中的任务不需要进入批次
+    pending = []
+    for i, user_input in enumerate(user_inputs):
+        cached_answer = try_local_arithmetic(user_input)
+        if cached_answer is None:
+            cached_answer = semantic_cache_lookup(user_input)
+        if cached_answer is not None:
+            results[i] = f"\n✅ Agent Finished! Final Answer: {cached_answer}"
+        else:
+            pending.append(i)
+    
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        print(f"\n--- 📦 Batch of {len(batch)} tasks ---")
+        
+        tasks = "\n".join(f"Task {n}: {user_inputs[i]}" for n, i in enumerate(batch, 1))
+        history = [
+            {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": tasks}
+        ]
+        llm_response = call_llm(history, early_exit=False)["content"]
+        print(f"LLM Response:\n{llm_response}")
+        
+        # 解析 JSON 数组，按任务编号取回各自的答案
+        answers = {}
+        array_match = BATCH_RESULT_RE.search(llm_response)
+        try:
+            items = orjson.loads(array_match.group(0)) if array_match else []
+        except orjson.JSONDecodeError as e:
+            print(f"❌ Failed to parse batch response: {e}")
+            items = []
+        for item in items:
+            # 答案可能是 0 这样的假值，只排除缺失和空字符串；任务编号可能是 "1" 这样的字符串
+            if not isinstance(item, dict) or item.get("needs_tool") or item.get("answer") in (None, ""):
+                continue
+            try:
+                answers[int(item.get("task"))] = str(item["answer"])
+            except (TypeError, ValueError):
+                continue
+        
+        for n, i in enumerate(batch, 1):
+            if n in answers:
+                # 批量答案未经工具校验，不写入语义缓存，避免一次错答被反复复用
+                results[i] = f"\n✅ Agent Finished! Final Answer: {answers[n]}"
+            else:
+                # 需要工具或解析失败的任务回退到单独的 Agent Loop
+                results[i] = run_agent_loop(user_inputs[i], system_prompt)
+    
+    return results
+
 # --- 运行示例 ---
 
 SYSTEM_PROMPT = """
@@ -182,34 +746,37 @@ SYSTEM_PROMPT = """
 
 ## 输出格式要求：
 1. **思考 (Thought)**: 描述你的推理过程、计划和要使用的工具。
-2. **行动 (Action)**: 如果需要工具，必须输出 JSON 格式，并严格封装在 [ACTION_START] 和 [ACTION_END] 标签内。
+2. **行动 (Action)**: 如果需要工具，通过函数调用 (tool calls) 调用提供给你的工具。
 3. **观察 (Observation)**: 这是工具返回的结果，你必须在下一轮 Thought 中利用它。
 
 ## 重要规则：
 - 当你确定任务已完成时，必须以 'Final Answer:' 开头给出最终结果。
 - 每次响应必须包含 Thought 部分
-- 如果需要使用工具，必须严格按照 JSON 格式输出 Action
 - 不要在一个响应中同时包含 Action 和 Final Answer
+- 如果有多个互不依赖的工具调用，可以在同一个响应中一起发起，它们会被并发执行
 
-## 可用工具：
-- {"tool": "add_numbers", "description": "对两个数字做加法运算", "args": {"a": float, "b": float}}
-
-## 示例响应格式：
+## 最终答案示例：
 ```
-Thought: 我需要计算两个数字的和，我将使用 add_numbers 工具。
-[ACTION_START]
-{"tool": "add_numbers", "args": {"a": 123, "b": 456}}
-[ACTION_END]
+Thought: 我已经获得了计算结果，现在可以给出最终答案。
+Final Answer: 123 加上 456 的结果是 579。
 ```
+"""
+
+BATCH_SYSTEM_PROMPT = """
+你是智能计算器Agent。你会一次收到多个相互独立的计算任务，格式为 "Task 1: ...", "Task 2: ..."。
 
-或
+## 输出格式要求：
+- 只输出一个 JSON 数组，不要输出数组以外的任何内容。
+- 数组中每个元素对应一个任务，按任务编号索引：{"task": 任务编号, "answer": "最终答案"}
+- 如果某个任务无法直接可靠地给出答案、需要调用工具，输出 {"task": 任务编号, "needs_tool": true}
 
+## 示例响应格式：
 ```
-Thought: 我已经获得了计算结果，现在可以给出最终答案。
-Final Answer: 123 加上 456 的结果是 579。
+[{"task": 1, "answer": "123 加上 456 的结果是 579。"}, {"task": 2, "needs_tool": true}]
 ```
 """
 
-user_input = "计算 123 加上 456 减去 789 的结果是多少？"
-final_result = run_agent_loop(user_input, SYSTEM_PROMPT)
-print(final_result)
\ No newline at end of file
+if __name__ == "__main__":
+    user_input = "计算 123 加上 456 减去 789 的结果是多少？"
+    final_result = run_agent_loop(user_input, SYSTEM_PROMPT)
+    print(final_result)
\ No newline at end of file
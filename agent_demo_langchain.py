@@ -1,25 +1,32 @@
 """
 LangChain version of the ReAct agent demo.
 
-This script replicates the functionality of `agent_demo.py` using the LangChain framework.
+This script replicates the functionality of `agent_demo.py` using LangChain building blocks.
 It defines a simple calculator agent with a single tool `add_numbers`, connects to the
 DeepSeek API via ChatOpenAI, and runs a ReAct-style agent loop.
 
-Unlike the original custom implementation, LangChain provides built‑in prompt templates
-for each agent type. The `STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION` agent already
-includes a prompt that instructs the LLM to follow the ReAct format, list available tools,
-and output actions in a structured JSON format. Therefore no explicit system prompt is needed.
+Instead of `initialize_agent` + `AgentExecutor` (a large built-in prompt template, an
+`LLMChain` with callbacks and an output parser on every step), the loop here is a thin
+wrapper around `llm.stream`: the system prompt is rendered from the tool definitions, and
+actions are parsed from `[ACTION_START]...[ACTION_END]` with the same pre-compiled regexes
+as `agent_demo.py`. Streaming stops as soon as a complete action has been received.
 
 Usage:
     Ensure DEEPSEEK_API_KEY is set in .env or environment.
+    Install: pip install langchain-openai "httpx[http2]"
     Run: python agent_demo_langchain.py
 """
 
+import atexit
 import os
+import httpx
+import orjson
 from dotenv import load_dotenv
-from langchain.tools import StructuredTool
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.tools import StructuredTool
 from langchain_openai import ChatOpenAI
-from langchain.agents import initialize_agent, AgentType
+
+from agent_demo import ACTION_END_TAG, ACTION_RE, FINAL_ANSWER_RE, parse_actions
 
 # Load environment variables
 load_dotenv()
@@ -44,48 +51,115 @@ if not api_key:
 base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
 model_name = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
 
+# Share one pooled HTTP/2 client across all ChatOpenAI instances, so concurrent agents
+# multiplex their requests over the same TLS connection to the DeepSeek host
+SHARED_HTTP = httpx.Client(
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60),
+    timeout=httpx.Timeout(connect=10, read=60, write=10, pool=5),
+    http2=True,
+)
+atexit.register(SHARED_HTTP.close)
+
 llm = ChatOpenAI(
     model=model_name,
     openai_api_key=api_key,
     openai_api_base=base_url,
     temperature=0.1,
     max_tokens=2000,
+    streaming=True,
+    http_client=SHARED_HTTP,
 )
 
-# 3. Create ReAct agent
+# 3. Build the ReAct prompt from the tool definitions
 tools = [tool]
+tools_by_name = {t.name: t for t in tools}
 
-# LangChain's `initialize_agent` creates an agent with a default ReAct prompt tailored for
-# structured chat (multi‑input tools). The prompt is automatically constructed from the
-# tool descriptions and the agent type.
-agent = initialize_agent(
-    tools,
-    llm,
-    agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-    verbose=True,
-    max_iterations=5,
-    early_stopping_method="generate",
+tool_descriptions = "\n".join(
+    f'- {{"tool": "{t.name}", "description": "{t.description}", "args": {orjson.dumps(t.args).decode()}}}'
+    for t in tools
 )
 
+SYSTEM_PROMPT = f"""
+你是智能计算器Agent。你的目标是根据用户指令完成数学计算。
+你必须遵循 ReAct 框架：
+
+## 输出格式要求：
+1. **思考 (Thought)**: 描述你的推理过程、计划和要使用的工具。
+2. **行动 (Action)**: 如果需要工具，必须输出 JSON 格式，并严格封装在 [ACTION_START] 和 [ACTION_END] 标签内。
+3. **观察 (Observation)**: 这是工具返回的结果，你必须在下一轮 Thought 中利用它。
+
+## 重要规则：
+- 当你确定任务已完成时，必须以 'Final Answer:' 开头给出最终结果。
+- 每次响应必须包含 Thought 部分
+- 不要在一个响应中同时包含 Action 和 Final Answer
+- 每个响应最多只能包含一个 Action 块；多个互不依赖的工具调用请放在该块的 JSON 数组中
+
+## 可用工具：
+{tool_descriptions}
+
+## 示例响应格式：
+```
+Thought: 我需要计算两个数字的和，我将使用 add_numbers 工具。
+[ACTION_START]
+{{"tool": "add_numbers", "args": {{"a": 123, "b": 456}}}}
+[ACTION_END]
+```
+"""
+
+# 4. Agent loop
+def run_agent(user_input: str, max_steps: int = 5) -> str:
+    """Run the ReAct loop for a single user input and return the final answer."""
+    messages = [SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content=user_input)]
+
+    for step in range(max_steps):
+        print(f"\n--- 🔄 Step {step + 1} ---")
+
+        # Stream the response and stop reading once a complete action has arrived
+        # (only the newly received text is searched for the end tag)
+        llm_response = ""
+        search_from = 0
+        for chunk in llm.stream(messages):
+            llm_response += chunk.content
+            if llm_response.find(ACTION_END_TAG, search_from) != -1 and ACTION_RE.search(llm_response):
+                break
+            search_from = max(0, len(llm_response) - len(ACTION_END_TAG) + 1)
+        llm_response = llm_response.strip()
+        print(f"LLM Response:\n{llm_response}")
+
+        final_match = FINAL_ANSWER_RE.search(llm_response)
+        if final_match:
+            return f"\n✅ Agent Finished! Final Answer: {final_match.group(1).strip()}"
+
+        action_match = ACTION_RE.search(llm_response)
+        if not action_match:
+            print("🛑 Error: LLM output is ambiguous. Stopping.")
+            return "❌ Agent failed to produce a valid action or final answer."
+
+        messages.append(AIMessage(content=llm_response))
+
+        observations = []
+        try:
+            for action_dict in parse_actions(action_match.group(1)):
+                print(f"🛠️ Executing Tool: {action_dict['tool']} with args: {action_dict['args']}")
+                if action_dict["tool"] not in tools_by_name:
+                    raise ValueError(f"Tool {action_dict['tool']} not registered.")
+                observation_result = tools_by_name[action_dict["tool"]].invoke(action_dict["args"])
+                print(f"📢 Observation: {observation_result}")
+                observations.append(f"Observation: {observation_result}")
+        except (KeyError, ValueError) as e:
+            error_message = f"Tool Execution Error: {e}"
+            print(f"❌ {error_message}")
+            observations.append(f"Observation: {error_message}")
+
+        messages.append(HumanMessage(content="\n".join(observations)))
+
+    return "❌ Max steps reached without a final answer."
+
 def main():
     """Run the agent with a sample query."""
-    # Print the built‑in prompt template for inspection
-    try:
-        prompt = agent.agent.llm_chain.prompt
-        print("=== Built‑in ReAct Prompt Template ===")
-        if hasattr(prompt, 'messages'):
-            for i, msg in enumerate(prompt.messages):
-                print(f"\n--- Message {i} ({msg.__class__.__name__}) ---")
-                print(msg.prompt.template if hasattr(msg.prompt, 'template') else msg.content)
-        else:
-            print(prompt)
-        print("=" * 50)
-    except AttributeError as e:
-        print(f"Could not retrieve prompt template: {e}")
-
     user_input = "计算 123 加上 456 减去 789 的结果是多少？"
-    result = agent.run(user_input)
+    result = run_agent(user_input)
     print(result)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,258 @@
+import os
+
+import pytest
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "test-key")
+
+import agent_demo
+
+
+@pytest.fixture
+def plan_cache(tmp_path, monkeypatch):
+    """使用临时文件作为计划模板缓存"""
+    monkeypatch.setattr(agent_demo, "PLAN_CACHE_PATH", str(tmp_path / "plan_cache.json"))
+    monkeypatch.setattr(agent_demo, "_plan_cache", None)
+    monkeypatch.setattr(agent_demo, "RESPONSE_CACHE_ENABLED", True)
+
+
+def _add(a, b):
+    return {"tool": "add_numbers", "args": {"a": a, "b": b}}, a + b
+
+
+def test_plan_cache_replays_template_on_new_numbers(plan_cache):
+    agent_demo.plan_cache_store(
+        "计算 123 加上 456 减去 789 的结果是多少？",
+        [_add(123, 456), _add(579, -789)],
+        "123 加上 456 减去 789 的结果是 -210。",
+    )
+    assert agent_demo.run_cached_plan("计算 10 加上 20 减去 5 的结果是多少？") == 25
+
+
+def test_plan_cache_skips_ambiguous_equal_values(plan_cache):
+    agent_demo.plan_cache_store(
+        "有 2 个，又拿 2 个，再拿 4 个，一共多少个？",
+        [_add(2, 2), _add(4, 4)],
+        "一共 8 个。",
+    )
+    assert agent_demo.run_cached_plan("有 3 个，又拿 5 个，再拿 7 个，一共多少个？") is None
+
+
+def test_plan_cache_skips_answer_not_produced_by_last_tool(plan_cache):
+    agent_demo.plan_cache_store(
+        "计算 123 加上 456 减去 789 的结果是多少？",
+        [_add(123, 456)],
+        "123 + 456 = 579，再减去 789，结果是 -210",
+    )
+    assert agent_demo.run_cached_plan("计算 10 加上 20 减去 5 的结果是多少？") is None
+
+
+def test_plan_cache_skips_unused_prompt_numbers(plan_cache):
+    agent_demo.plan_cache_store(
+        "计算 123 加上 456 减去 789 的结果是多少？",
+        [_add(123, 456)],
+        "结果是 579",
+    )
+    assert agent_demo.run_cached_plan("计算 10 加上 20 减去 5 的结果是多少？") is None
+
+
+@pytest.fixture
+def semantic_cache(tmp_path, monkeypatch):
+    """使用临时文件作为语义缓存"""
+    monkeypatch.setattr(agent_demo, "SEMANTIC_CACHE_PATH", str(tmp_path / "semantic_cache.json"))
+    monkeypatch.setattr(agent_demo, "_semantic_entries", None)
+    monkeypatch.setattr(agent_demo, "_semantic_vectors", [])
+    monkeypatch.setattr(agent_demo, "RESPONSE_CACHE_ENABLED", True)
+
+
+def test_semantic_cache_hits_rephrased_prompt(semantic_cache):
+    agent_demo.semantic_cache_store("计算 123 加上 456 的结果是多少？", "579")
+    assert agent_demo.semantic_cache_lookup("请计算 123 加上 456 的结果是多少？") == "579"
+
+
+@pytest.mark.parametrize("stored, query", [
+    ("小明有 123 个苹果，然后买了 456 个，又吃掉了 789 个，还剩多少个？",
+     "小明有 123 个苹果，然后吃掉了 456 个，又买了 789 个，还剩多少个？"),
+    ("What is 12 plus 30 minus 5?", "What is 12 minus 30 plus 5?"),
+])
+def test_semantic_cache_misses_swapped_operations(semantic_cache, stored, query):
+    agent_demo.semantic_cache_store(stored, "answer")
+    assert agent_demo.semantic_cache_lookup(query) is None
+
+
+@pytest.mark.parametrize("stored, query", [
+    ("商店原来有一百二十个苹果，上午卖出四十五个，下午又运来三十个，现在一共有多少个苹果？",
+     "商店原来有一百二十个苹果，上午卖出四十五个，下午又运来六十个，现在一共有多少个苹果？"),
+    ("小明有 12 个苹果，小红的苹果是小明的两倍，小红有多少个？",
+     "小明有 12 个苹果，小红的苹果是小明的三倍，小红有多少个？"),
+])
+def test_semantic_cache_misses_different_chinese_numerals(semantic_cache, stored, query):
+    agent_demo.semantic_cache_store(stored, "answer")
+    assert agent_demo.semantic_cache_lookup(query) is None
+    assert agent_demo.semantic_cache_lookup(stored) == "answer"
+
+
+def test_local_arithmetic_evaluates_chinese_operators():
+    assert agent_demo.try_local_arithmetic("计算 123 加上 456 减去 789 的结果是多少？") == -210
+
+
+@pytest.mark.parametrize("prompt", [
+    "1" + "0" * 400 + " / 3",
+    "1.5 * 1" + "0" * 400,
+    "1" + "+1" * 3000,
+    "1 / 0",
+    "帮我写首诗",
+])
+def test_local_arithmetic_falls_through_on_unsupported_input(prompt):
+    assert agent_demo.try_local_arithmetic(prompt) is None
+
+
+def test_parse_actions_accepts_object_or_array():
+    action = '{"tool": "add_numbers", "args": {"a": 1, "b": 2}}'
+    assert agent_demo.parse_actions(action) == [{"tool": "add_numbers", "args": {"a": 1, "b": 2}}]
+    assert len(agent_demo.parse_actions(f"[{action}, {action}]")) == 2
+
+
+def test_response_cache_evicts_expired_and_least_recently_used(monkeypatch):
+    monkeypatch.setattr(agent_demo, "RESPONSE_CACHE", agent_demo.OrderedDict())
+    monkeypatch.setattr(agent_demo, "RESPONSE_CACHE_MAX_SIZE", 2)
+    agent_demo.RESPONSE_CACHE["stale"] = ({"content": "stale"}, 0)
+    agent_demo._response_cache_put("a", {"content": "a"})
+    assert "stale" not in agent_demo.RESPONSE_CACHE
+
+    agent_demo._response_cache_put("b", {"content": "b"})
+    assert agent_demo._response_cache_get("a") == {"content": "a"}
+    agent_demo._response_cache_put("c", {"content": "c"})
+    assert list(agent_demo.RESPONSE_CACHE) == ["a", "c"]
+
+
+def test_run_agent_batch_accepts_zero_and_string_task_ids(semantic_cache, monkeypatch):
+    reply = '[{"task": "1", "answer": 0}, {"task": 2, "answer": "7"}, {"task": 3, "needs_tool": true}]'
+    monkeypatch.setattr(agent_demo, "call_llm", lambda *args, **kwargs: {"role": "assistant", "content": reply})
+    monkeypatch.setattr(agent_demo, "run_agent_loop", lambda user_input, system_prompt: "fallback")
+
+    results = agent_demo.run_agent_batch(["把零写出来", "三和四的总数", "用工具算一下"], "system")
+
+    assert results == [
+        "\n✅ Agent Finished! Final Answer: 0",
+        "\n✅ Agent Finished! Final Answer: 7",
+        "fallback",
+    ]
+    assert agent_demo.semantic_cache_lookup("把零写出来") is None
+
+
+def test_compact_history_keeps_tool_messages_with_their_turn(monkeypatch):
+    monkeypatch.setattr(agent_demo, "HISTORY_CHAR_LIMIT", 0)
+    tool_call = {"id": "call_1", "type": "function", "function": {"name": "add_numbers", "arguments": "{}"}}
+    history = [
+        {"role": "system", "content": "system"},
+        {"role": "user", "content": "task"},
+        {"role": "assistant", "content": "step 1"},
+        {"role": "user", "content": "Observation: 579"},
+        {"role": "assistant", "content": "", "tool_calls": [tool_call, {**tool_call, "id": "call_2"}]},
+        {"role": "tool", "tool_call_id": "call_1", "content": "3"},
+        {"role": "tool", "tool_call_id": "call_2", "content": "7"},
+        {"role": "assistant", "content": "step 3"},
+        {"role": "user", "content": "Observation: -210"},
+    ]
+    turns = [(2, "add_numbers(123, 456) = 579"), (3, "add_numbers(1, 2) = 3; add_numbers(3, 4) = 7"),
+             (2, "add_numbers(579, -789) = -210")]
+
+    agent_demo.compact_history(history, turns, keep_turns=2)
+
+    assert history[2] == {"role": "user", "content": "[Earlier steps summarized: add_numbers(123, 456) = 579]"}
+    assert [msg["role"] for msg in history[3:]] == ["assistant", "tool", "tool", "assistant", "user"]
+    assert turns[0] == (1, "add_numbers(123, 456) = 579")
+    assert len(turns) == 3
+
+
+@pytest.mark.parametrize("header, expected", [("3600", 30), ("5", 5), (None, None)])
+def test_retry_after_is_capped(header, expected):
+    class Response:
+        headers = {} if header is None else {"Retry-After": header}
+
+    retry = agent_demo.LLM_RETRY.increment(method="POST", url="/chat/completions")
+    assert isinstance(retry, agent_demo.CappedRetry)
+    assert retry.get_retry_after(Response()) == expected
+
+
+class FakeSession:
+    """按顺序返回预设 SSE 数据行的假会话，并记录每次请求的 payload"""
+
+    def __init__(self, *streams):
+        self.streams = list(streams)
+        self.payloads = []
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        self.payloads.append(agent_demo.orjson.loads(data))
+        return FakeResponse(self.streams.pop(0))
+
+
+class FakeResponse:
+    def __init__(self, chunks):
+        self.lines = [b"data: " + agent_demo.orjson.dumps(chunk) for chunk in chunks] + [b"data: [DONE]"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+
+def _sse_chunk(delta, finish_reason=None):
+    return {"choices": [{"delta": delta, "finish_reason": finish_reason}]}
+
+
+@pytest.fixture
+def fake_session(plan_cache, semantic_cache, monkeypatch):
+    """替换 SESSION，并使用空的响应缓存"""
+    monkeypatch.setattr(agent_demo, "RESPONSE_CACHE", agent_demo.OrderedDict())
+
+    def install(*streams):
+        session = FakeSession(*streams)
+        monkeypatch.setattr(agent_demo, "SESSION", session)
+        return session
+
+    return install
+
+
+def test_run_agent_loop_reassembles_streamed_tool_call(fake_session):
+    session = fake_session(
+        [
+            _sse_chunk({"content": "Thought: 用 add_numbers", "tool_calls": [
+                {"index": 0, "id": "call_1", "type": "function",
+                 "function": {"name": "add_", "arguments": '{"a": 1'}}]}),
+            _sse_chunk({"tool_calls": [{"index": 0, "function": {"name": "numbers", "arguments": '23, "b": 456}'}}]}),
+            _sse_chunk({}, finish_reason="tool_calls"),
+        ],
+        [_sse_chunk({"content": "Final Answer: 579"}, finish_reason="stop")],
+    )
+
+    result = agent_demo.run_agent_loop("帮我算一下苹果的总数", "system")
+
+    assert result == "\n✅ Agent Finished! Final Answer: 579"
+    assert session.payloads[1]["messages"][2:] == [
+        {"role": "assistant", "content": "Thought: 用 add_numbers", "tool_calls": [
+            {"id": "call_1", "type": "function",
+             "function": {"name": "add_numbers", "arguments": '{"a": 123, "b": 456}'}}]},
+        {"role": "tool", "tool_call_id": "call_1", "content": "579"},
+    ]
+
+
+def test_call_llm_retries_truncated_step_with_full_budget(fake_session):
+    session = fake_session(
+        [_sse_chunk({"content": "Thought: 我需要先"}, finish_reason="length")],
+        [_sse_chunk({"content": "Final Answer: 579"}, finish_reason="stop")],
+    )
+    messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "task"}]
+
+    message = agent_demo.call_llm(messages, max_tokens=agent_demo.STEP_MAX_TOKENS)
+
+    assert message == {"role": "assistant", "content": "Final Answer: 579"}
+    assert [payload["max_tokens"] for payload in session.payloads] == [256, 2000]
+    assert [cached for cached, _ in agent_demo.RESPONSE_CACHE.values()] == [message]